@@ -1,24 +1,32 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import subprocess
 import shlex
 import time
 import atexit
-import platform
+import threading
 import shutil
 import hashlib
+import io
+import json
+import mmap
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Tuple, Dict
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Tuple, Dict
 
-import requests
-import serial.tools.list_ports
 from arcompile_version import __version__ as VERSION
 
 # ======== CONFIGURACIÓN POR DEFECTO ========
 REMOTE           = "minecraft_server"
 REMOTE_DIR       = "/home/ubuntu/compilacion_esp32"
+# Caché de compilación de arduino-cli (core.a, etc.) que sobrevive entre builds
+REMOTE_CACHE_DIR = "/home/ubuntu/.arduino-cache"
 
 # FQBN por defecto (puedes sobreescribirlo desde CLI: esp32c3 / s3 / dev / da / micro / fqbn=...)
 FQBN_DEFAULT     = "esp32:esp32:esp32"
@@ -28,13 +36,27 @@ MAX_SIZE         = 1310720   # 1.3 MB (límite heurístico para decidir min_spif
 REPO_VERSION_URL = "https://raw.githubusercontent.com/jaestefaniah27/online_compiler/main/arcompile_version.py"
 # Estimación basada en líneas de código (en segundos por línea)
 TIME_PER_LINE    = 0.02
+AVG_BYTES_PER_LINE = 40     # para estimar líneas a partir del tamaño, sin abrir archivos
+# Carpetas que nunca forman parte del sketch
+IGNORE_DIRS      = frozenset({".git", ".vscode", "__pycache__", "binarios", "releases", "build"})
+# Fuentes del sketch que se hashean y se suben al servidor
+SOURCE_SUFFIXES  = frozenset({".ino", ".cpp", ".h"})
 # Archivos de log
 COMPILE_LOG      = Path("compile.log")
 ERROR_LOG        = Path("error.log")
+# Caché de la versión remota (comprobación de `arcompile update`)
+VERSION_CACHE     = Path.home() / ".cache" / "arcompile" / "version.json"
+VERSION_CACHE_TTL = 6 * 3600    # segundos
+# Caché de digests por archivo (ruta → mtime, tamaño, blake2b) para hash_proyecto
+HASH_CACHE       = Path(".build_hash.json")
+# Huella (hash:fqbn:partición) de la compilación cuyos artefactos hay en ./binarios
+BUILD_HASH       = Path(".build_hash")
+# Huella de libraries.txt (+ servidor) ya instalada en remoto
+LIBS_HASH        = Path(".libs_installed.hash")
 # ==========================================
 
-# Mapeos útiles
-BOARD_ALIASES = {
+# Mapeos útiles (de sólo lectura)
+BOARD_ALIASES = MappingProxyType({
     "dev":       "esp32:esp32:esp32",
     "da":        "esp32:esp32:esp32da",
     "c3":        "esp32:esp32:esp32c3",
@@ -43,74 +65,120 @@ BOARD_ALIASES = {
     "esp32s3":   "esp32:esp32:esp32s3",
     # NUEVO: Arduino Micro (ATmega32U4)
     "micro":     "arduino:avr:micro",
-}
+})
+
+# Familia ESP32 según el nombre de placa (el primero que aparezca)
+_FAMILY_BY_BOARD_SUFFIX = (("c3", "esp32c3"), ("s3", "esp32s3"))
+
+
+class FlashLayout(NamedTuple):
+    """Offsets de escritura de una familia ESP32 (inmutable, acceso por atributo)."""
+    bootloader: int
+    partitions: int
+    application: int
+    boot_app0: Optional[int] = None  # None: la familia no usa boot_app0
+
 
 # Offsets de flasheo por familia ESP32
-FLASH_LAYOUT = {
+FLASH_LAYOUT = MappingProxyType({
     # ESP32 clásico / DA
-    "esp32": {
-        "bootloader": 0x1000,
-        "partitions": 0x8000,
-        "boot_app0":  0xE000,
-        "application":0x10000,
-        "use_boot_app0": True
-    },
+    "esp32":   FlashLayout(bootloader=0x1000, partitions=0x8000, application=0x10000,
+                           boot_app0=0xE000),
     # ESP32-C3 (RISC-V)
-    "esp32c3": {
-        "bootloader": 0x0000,
-        "partitions": 0x8000,
-        "application":0x10000,
-        "use_boot_app0": False
-    },
+    "esp32c3": FlashLayout(bootloader=0x0000, partitions=0x8000, application=0x10000),
     # ESP32-S3
-    "esp32s3": {
-        "bootloader": 0x0000,
-        "partitions": 0x8000,
-        "application":0x10000,
-        "use_boot_app0": False
-    },
+    "esp32s3": FlashLayout(bootloader=0x0000, partitions=0x8000, application=0x10000),
     # Nota: familia "avr" no usa esptool ni offsets
-}
-
-SSH_BASE_OPTS = (
-    "-n -T "  # ssh: NO stdin y sin pty
-    "-o BatchMode=yes "
-    "-o StrictHostKeyChecking=no "
-    "-o UserKnownHostsFile=/dev/null "
-    "-o ConnectTimeout=6 "
-    "-o ServerAliveInterval=5 "
-    "-o ServerAliveCountMax=1 "
-    "-o ConnectionAttempts=1 "
-    "-o LogLevel=QUIET"
+})
+
+# Línea de tamaño de arduino-cli: "Sketch uses 123,456 bytes (9%) ... Maximum is ..."
+_SKETCH_RE = re.compile(r"Sketch uses\s+([\d,]+)\s+bytes.*?Maximum is\s+([\d,]+)\s+bytes")
+# Rol de cada artefacto de ./binarios según su nombre (en minúsculas); el grupo
+# que coincide es la clave en el diccionario de archivos a flashear
+_ART_RE = re.compile(
+    r"^(?:(?P<application_hex>.*\.hex)"
+    r"|(?P<bootloader>.*\.bootloader\.bin)"
+    r"|(?P<partitions>.*\.partitions\.bin)"
+    r"|(?P<boot_app0>.*app0\.bin)"
+    r"|(?P<application>.*\.ino\.bin))$"
 )
-
-SCP_BASE_OPTS = (
-    "-T "  # scp: NO usar -n (no existe)
-    "-o BatchMode=yes "
-    "-o StrictHostKeyChecking=no "
-    "-o UserKnownHostsFile=/dev/null "
-    "-o ConnectTimeout=6 "
-    "-o ServerAliveInterval=5 "
-    "-o ServerAliveCountMax=1 "
-    "-o ConnectionAttempts=1 "
-    "-o LogLevel=QUIET"
+# Imágenes combinadas (bootloader+app): nunca se flashean por roles
+_COMBINED_RE = re.compile(r"with_bootloader|merged")
+# Error de gcc por cabecera inexistente (la única falta que arreglan las librerías)
+_MISSING_HEADER_RE = re.compile(r"fatal error: [^\n:]+\.h(?:pp)?: No such file or directory")
+# FQBN en compile.log (cabecera "FQBN: ..." o la propia línea de comando).
+# En bytes: se busca directamente sobre el inicio del archivo, sin decodificar
+_FQBN_RE = re.compile(rb"(?:--fqbn[ =]|FQBN:\s*|fqbn=)([A-Za-z0-9_]+:[A-Za-z0-9_]+:[A-Za-z0-9_]+)")
+
+# Placas AVR con USB nativo (VID, PID): nunca se les pasa esptool
+_AVR_VIDPID = frozenset({
+    (0x2341, 0x8037),  # Arduino Micro
+    (0x2341, 0x0037),  # Arduino Micro (bootloader)
+})
+# Puentes USB-serie / USB nativo de placas ESP32 conocidas (VID, PID)
+_ESP_VIDPID = frozenset({
+    (0x10C4, 0xEA60),  # Silicon Labs CP210x
+    (0x1A86, 0x7523),  # CH340
+    (0x1A86, 0x55D4),  # CH9102
+    (0x303A, 0x1001),  # ESP32-C3/S3 USB-Serial/JTAG
+    (0x303A, 0x1002),  # ESP32-S2/S3 USB CDC (TinyUSB)
+})
+# Placas reconocidas por (VID, PID): van por delante de los puertos que sólo
+# parecen una placa por su descripción
+_KNOWN_VIDPID = _ESP_VIDPID | _AVR_VIDPID
+# Descripción de un puerto serie de placa: una sola búsqueda por puerto
+_PORT_RE = re.compile(r"cp210|silicon|usb|esp32|ch340|cdc|arduino|caterina|atmega32u4",
+                      re.IGNORECASE)
+
+# Conexión SSH maestra compartida (ControlMaster): todas las llamadas ssh/rsync
+# viajan por el mismo TCP ya autenticado. OpenSSH de Windows no lo soporta.
+SSH_CONTROL_PATH = Path.home() / ".ssh" / "arcompile-cm-%r@%h:%p"
+SSH_MUX_OPTS = [
+    "-o", "ControlMaster=auto",
+    "-o", f"ControlPath={SSH_CONTROL_PATH}",
+    "-o", "ControlPersist=120s",
+] if os.name != "nt" else []
+
+# La compresión ssh compensa por WAN (fuentes, tar de binarios y logs comprimen
+# 2-4x); en una LAN rápida sólo gasta CPU: ARCOMPILE_FAST_LAN=1 la desactiva.
+SSH_COMPRESSION_OPTS = (
+    [] if os.environ.get("ARCOMPILE_FAST_LAN") else ["-o", "Compression=yes"]
 )
 
+# Opciones en forma argv: los comandos se lanzan sin shell intermedia
+SSH_BASE_OPTS = [
+    "-n", "-T",  # ssh: NO stdin y sin pty
+    "-o", "BatchMode=yes",
+    "-o", "StrictHostKeyChecking=no",
+    "-o", "UserKnownHostsFile=/dev/null",
+    "-o", "ConnectTimeout=6",
+    "-o", "ServerAliveInterval=5",
+    "-o", "ServerAliveCountMax=1",
+    "-o", "ConnectionAttempts=1",
+    "-o", "LogLevel=QUIET",
+] + SSH_COMPRESSION_OPTS + SSH_MUX_OPTS
+
+# Igual que SSH_BASE_OPTS pero con stdin: para canalizar un tar por ssh
+SSH_PIPE_OPTS = [o for o in SSH_BASE_OPTS if o != "-n"]
+
+# ssh que lanza rsync (-e): también sin -n, rsync habla por su stdin
+RSYNC_SSH_OPTS = SSH_PIPE_OPTS
+
 
 # Tiempo de inicio para cálculo de elapsed
 _start_time = time.time()
 
-def run_retry(cmd: str, attempts: int = 3, timeout: int = 30, sleep_between: float = 1.0):
+def run_retry(cmd: list[str], attempts: int = 3, timeout: int = 30, sleep_between: float = 1.0):
     """
-    Ejecuta un comando con timeout y reintentos.
+    Ejecuta un comando (argv) con timeout y reintentos.
     - timeout: segundos para matar el proceso si se cuelga
     - attempts: número de intentos totales
     """
     last_err = None
     for i in range(1, attempts + 1):
-        print("»", cmd)
+        print("»", shlex.join(cmd))
         try:
-            subprocess.run(cmd, shell=True, check=True, timeout=timeout)
+            subprocess.run(cmd, check=True, timeout=timeout)
             return
         except subprocess.TimeoutExpired as e:
             print(f"⏳ Timeout (t={timeout}s) en intento {i}/{attempts}. Reintentando…")
@@ -125,27 +193,117 @@ def run_retry(cmd: str, attempts: int = 3, timeout: int = 30, sleep_between: flo
 def ssh_exec(remote_cmd: str, attempts: int = 3, timeout: int = 20):
     """
     Ejecuta un comando remoto por ssh con opciones robustas, timeout y reintentos.
+    remote_cmd lo interpreta la shell remota (citar con shlex.quote/shlex.join).
     """
-    cmd = f"ssh {SSH_BASE_OPTS} {REMOTE} {remote_cmd}"
+    cmd = ["ssh", *SSH_BASE_OPTS, REMOTE, remote_cmd]
     return run_retry(cmd, attempts=attempts, timeout=timeout)
 
-def scp_upload_many(local_paths: list[str], remote_dir: str, attempts: int = 3, timeout: int = 60):
+def _run_tar_stream(cmd: list[str], escribir, attempts: int, timeout: int):
+    """
+    Lanza `cmd` con su stdin conectado por tubería y llama a escribir(stdin)
+    para generar el tar. Mismos reintentos que run_retry; el timeout cubre toda
+    la transferencia (se mata el proceso al vencer).
+    """
+    code = None
+    for i in range(1, attempts + 1):
+        print("»", shlex.join(cmd))
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        vigilante = threading.Timer(timeout, p.kill)
+        vigilante.start()
+        stream = p.stdin
+        detalle = ""
+        try:
+            resultado = escribir(stream)
+        except (OSError, tarfile.TarError) as e:  # tubería rota / tar truncado
+            detalle, resultado = f": {e}", None
+        finally:
+            try:
+                stream.close()
+            except OSError:
+                pass
+            code = p.wait()
+            vigilante.cancel()
+        if code == 0 and resultado is not None:
+            return resultado
+        print(f"⚠ Error de transferencia en intento {i}/{attempts} (código {code}){detalle}. Reintentando…")
+        time.sleep(1.0)
+    raise subprocess.CalledProcessError(code, cmd)
+
+def tar_upload_many(files: Dict[str, Path], remote_dir: str, pre_cmd: str = "",
+                    attempts: int = 3, timeout: int = 60):
+    """
+    Sube muchos archivos por UNA conexión ssh como un tar generado al vuelo con
+    tarfile (no hace falta tar local, sirve también en Windows).
+    - files: nombre de destino → ruta local (así se aplana sin copiar nada)
+    - pre_cmd: comando remoto a ejecutar antes de desempaquetar (misma conexión)
+    """
+    if not files:
+        return
+    remote_cmd = shlex.join(["tar", "-xf", "-", "-C", remote_dir])
+    if pre_cmd:
+        remote_cmd = f"{pre_cmd} && {remote_cmd}"
+
+    def escribir(stream):
+        with tarfile.open(fileobj=stream, mode="w|") as tar:
+            for name, path in files.items():
+                tar.add(path, arcname=name)
+        return True
+
+    cmd = ["ssh", *SSH_PIPE_OPTS, REMOTE, remote_cmd]
+    return _run_tar_stream(cmd, escribir, attempts, timeout)
+
+def _extraer_tar(stream, out_dir: Path):
+    """
+    Lee un tar en streaming y extrae en out_dir sólo los archivos regulares, por
+    nombre base (nunca rutas del emisor).
+    """
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = Path(member.name).name
+            with tar.extractfile(member) as src, open(out_dir / name, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+def rsync_upload_many(local_paths: list[str], remote_dir: str, attempts: int = 3, timeout: int = 60):
     """
-    Sube muchos archivos en un solo scp a un directorio remoto.
-    - local_paths: rutas locales (se citarán con comillas dobles para Windows)
-    - remote_dir: directorio remoto de destino (sin comillas internas)
+    Sube muchos archivos en un solo rsync: los archivos que ya están
+    en remoto sin cambios no se vuelven a transferir.
+    Se compara por contenido (--checksum) y sin conservar mtimes (sin -t): así un
+    archivo sólo cambia de fecha en remoto cuando cambia su contenido, y la caché
+    de arduino-cli no se invalida por un simple "touch" ni por la distinta
+    precisión de mtime entre Windows y Linux.
+    Sin -z: la compresión ya la hace ssh (Compression=yes, salvo con
+    ARCOMPILE_FAST_LAN); comprimir también en rsync sería hacerlo dos veces.
     """
     if not local_paths:
         return
-    def q_local(p: str) -> str:
-        # comillas dobles para Windows PowerShell/cmd
-        return f"\"{p.replace('\"', r'\\\"')}\""
-    srcs = " ".join(q_local(p) for p in local_paths)
-    dest = f'{REMOTE}:"{remote_dir.rstrip("/")}/"'
-    cmd = f"scp {SCP_BASE_OPTS} {srcs} {dest}"
+    dest = f'{REMOTE}:{remote_dir.rstrip("/")}/'
+    cmd = ["rsync", "--checksum", "-e", shlex.join(["ssh", *RSYNC_SSH_OPTS]), *local_paths, dest]
     return run_retry(cmd, attempts=attempts, timeout=timeout)
 
 
+def abrir_conexion_ssh():
+    """
+    Abre en segundo plano la conexión maestra SSH (si no hay ya una viva) para
+    que el resto de ssh/rsync la reutilicen sin repetir el handshake.
+    No se cierra al terminar: otras ejecuciones pueden estar usándola, y
+    ControlPersist la cierra sola tras 120 s sin uso.
+    """
+    if not SSH_MUX_OPTS:
+        return
+    check = subprocess.run(["ssh", *SSH_BASE_OPTS, "-O", "check", REMOTE],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if check.returncode == 0:
+        return
+    SSH_CONTROL_PATH.parent.mkdir(mode=0o700, exist_ok=True)
+    try:
+        # -f: ssh pasa a segundo plano tras autenticar; -N: sin comando remoto
+        subprocess.run(["ssh", *SSH_BASE_OPTS, "-f", "-N", REMOTE], timeout=15,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except subprocess.TimeoutExpired:
+        print("⚠ No se pudo abrir la conexión SSH maestra; se usarán conexiones sueltas.")
+        return
 
 
 @atexit.register
@@ -155,40 +313,129 @@ def _print_elapsed():
 
 
 def run(cmd, **kw):
-    # Permite cmd como str (usa shell) o como list (sin shell, más seguro en Windows)
-    if isinstance(cmd, (list, tuple)):
-        print("»", " ".join(shlex.quote(str(x)) for x in cmd))
-        subprocess.run(cmd, shell=False, check=True, **kw)
-    else:
-        print(f"» {cmd}")
-        subprocess.run(cmd, shell=True, check=True, **kw)
+    # cmd siempre en forma argv (list/tuple): sin shell, sin problemas de comillas
+    cmd = [str(x) for x in cmd]
+    print("»", shlex.join(cmd))
+    subprocess.run(cmd, check=True, **kw)
 
 
 
-def run_capture(cmd):
-    p = subprocess.run(cmd, shell=True, text=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if p.stderr:
-        ERROR_LOG.write_text(p.stderr, encoding='utf8')
-    return p.returncode, p.stdout, p.stderr
+def run_capture(cmd, tar_dir: Path, abort_on=None) -> Tuple[int, str]:
+    """
+    Ejecuta cmd, cuyo stdout es un tar que se extrae en tar_dir al vuelo, y
+    muestra su stderr en consola a medida que llega (p.ej. la salida del
+    compilador). Devuelve (código de salida, stderr completo).
+    abort_on (regex): en cuanto una línea de stderr coincide se termina el
+    proceso, sin esperar a que acabe un trabajo ya condenado.
+    """
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    buf_err = []
+
+    def tee_err(abort_on=abort_on):
+        for line in io.TextIOWrapper(p.stderr, errors="replace"):
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            buf_err.append(line)
+            if abort_on and abort_on.search(line):
+                p.terminate()
+                abort_on = None
+
+    t_err = threading.Thread(target=tee_err, daemon=True)
+    t_err.start()
+    try:
+        _extraer_tar(p.stdout, tar_dir)
+    except tarfile.TarError:
+        pass  # sin tar (la compilación falló antes): lo decide el código de salida
+    t_err.join()
+    code, err = p.wait(), "".join(buf_err)
+    # Sólo un fallo deja rastro: los avisos de un comando correcto no son errores
+    if code != 0 and err:
+        ERROR_LOG.write_text(err, encoding='utf8')
+    return code, err
+
+
+def _puertos_activos_windows() -> Optional[set]:
+    """
+    En Windows, los COM activos según HKLM\\HARDWARE\\DEVICEMAP\\SERIALCOMM (unos
+    pocos ms, frente a la enumeración SetupAPI/WMI de pyserial). None si no aplica.
+    """
+    if os.name != "nt":
+        return None
+    import winreg
+    try:
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"HARDWARE\DEVICEMAP\SERIALCOMM") as key:
+            activos, i = set(), 0
+            while True:
+                try:
+                    activos.add(winreg.EnumValue(key, i)[1])
+                except OSError:
+                    return activos
+                i += 1
+    except OSError:
+        return set()  # la clave no existe si no hay ningún puerto serie
+
+
+@lru_cache(maxsize=1)
+def _escanear_puertos() -> tuple:
+    """
+    (puerto, (vid, pid)) de las placas (ESP32/AVR): primero las de VID/PID
+    conocido y después las que lo parecen por la descripción. Se cachea durante
+    la ejecución: _escanear_puertos.cache_clear() fuerza un reescaneo.
+    """
+    activos = _puertos_activos_windows()
+    if activos is not None and not activos:
+        return ()  # sin puertos COM: no hace falta la enumeración lenta de pyserial
+    from serial.tools import list_ports
+    por_id, por_descripcion = [], []
+    for p in list_ports.comports():
+        if activos and p.device not in activos:
+            continue
+        if (p.vid, p.pid) in _KNOWN_VIDPID:
+            por_id.append((p.device, (p.vid, p.pid)))
+        elif _PORT_RE.search(p.description or ""):
+            por_descripcion.append((p.device, (p.vid, p.pid)))
+    return tuple(por_id + por_descripcion)
+
+
+def puertos_placa(excluir: frozenset = frozenset(),
+                  preferir: frozenset = frozenset()) -> tuple[str, ...]:
+    """
+    Puertos de placa detectados, sin los de (vid, pid) en `excluir` y con los
+    de `preferir` por delante (el resto conserva su orden).
+    """
+    puertos = [(dev, vidpid) for dev, vidpid in _escanear_puertos() if vidpid not in excluir]
+    puertos.sort(key=lambda p: p[1] not in preferir)
+    return tuple(dev for dev, _ in puertos)
+
+
+def buscar_puerto(avr: bool = False) -> Optional[str]:
+    """
+    Primer puerto de placa detectado, o None. Para AVR van primero las placas
+    AVR reconocidas; para ESP32 éstas quedan fuera (esptool no habla con ellas).
+    """
+    if avr:
+        puertos = puertos_placa(preferir=_AVR_VIDPID)
+    else:
+        puertos = puertos_placa(excluir=_AVR_VIDPID)
+    return puertos[0] if puertos else None
 
 
-def puerto_esp32():
-    print("🔍 Buscando puerto ESP32 …")
-    for p in serial.tools.list_ports.comports():
-        if any(t in p.description for t in ("CP210", "Silicon", "USB", "ESP32", "CH340", "CDC")):
-            print(f"✔ Detectado {p.device}")
-            return p.device
-    sys.exit("❌ ESP32 no encontrada")
+def puerto_esp32(avr: bool = False):
+    print("🔍 Buscando puerto ESP32 …" if not avr else "🔍 Buscando puerto AVR …")
+    dev = buscar_puerto(avr)
+    if dev:
+        print(f"✔ Detectado {dev}")
+        return dev
+    sys.exit("❌ Placa AVR no encontrada" if avr else "❌ ESP32 no encontrada")
 
 
 # === NUEVO: versión opcional que NO aborta si no hay puerto ===
-def puerto_esp32_optional():
+def puerto_esp32_optional(avr: bool = False):
     print("🔍 Buscando puerto (opcional) …")
-    for p in serial.tools.list_ports.comports():
-        if any(t in p.description for t in ("CP210", "Silicon", "USB", "ESP32", "CH340", "CDC", "Arduino", "CDC")):
-            print(f"✔ Detectado {p.device}")
-            return p.device
+    dev = buscar_puerto(avr)
+    if dev:
+        print(f"✔ Detectado {dev}")
+        return dev
     print("⚠ No se detectó puerto. Se continuará sin flashear.")
     return None
 # ==============================================================
@@ -201,43 +448,59 @@ def leer_libraries():
     return [l.strip() for l in f.read_text(encoding="utf8").splitlines() if l.strip()]
 
 
-def instalar_librerias(libs):
+def instalar_librerias(libs, forzar=False):
+    """
+    Instala las librerías en el servidor salvo que ya se hiciera con este mismo
+    libraries.txt contra este mismo servidor (LIBS_HASH).
+    """
     if not libs:
         return
+    huella = hashlib.blake2b("\n".join([REMOTE, *libs]).encode(), digest_size=16).hexdigest()
+    if not forzar and LIBS_HASH.exists() and LIBS_HASH.read_text().strip() == huella:
+        return
     print("• Instalando/actualizando librerías en servidor …")
-    for lib in libs:
-        run(f"ssh {REMOTE} arduino-cli lib install {shlex.quote(lib)} --no-overwrite")
+    # Un único arduino-cli para todas (una conexión y un arranque del CLI)
+    try:
+        # Sin reintentos (un nombre erróneo fallaría igual), pero con timeout:
+        # una descarga colgada no debe bloquear arcompile indefinidamente
+        ssh_exec(shlex.join(["arduino-cli", "lib", "install", *libs, "--no-overwrite"]),
+                 attempts=1, timeout=300)
+        LIBS_HASH.write_text(huella)
+        return
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        if len(libs) == 1:
+            print(f"⚠ No se pudo instalar la librería: {libs[0]}")
+            return
+        print("⚠ Falló la instalación conjunta → instalando librerías una a una …")
+    # Fallback: una a una, para que un nombre erróneo no bloquee al resto.
+    # Hasta 4 a la vez: cada ssh es un canal más sobre la conexión maestra
+    def instalar(lib):
+        cmd = ["ssh", *SSH_BASE_OPTS, REMOTE,
+               shlex.join(["arduino-cli", "lib", "install", lib, "--no-overwrite"])]
+        try:
+            p = subprocess.run(cmd, capture_output=True, text=True, timeout=180)
+            return p.returncode == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        resultados = list(ex.map(instalar, libs))
+    fallidas = [lib for lib, ok in zip(libs, resultados) if not ok]
+    for lib in fallidas:
+        print(f"⚠ No se pudo instalar la librería: {lib}")
+    if not fallidas:
+        LIBS_HASH.write_text(huella)
 
 
 def subir_proyecto(remote_proj):
     """
     Sube SOLO .ino, .h, .cpp (desde subcarpetas) y libraries.txt (si existe),
-    a la carpeta remota raíz, TODO en un ÚNICO comando `scp`, con timeouts y reintentos.
+    a la carpeta remota raíz, TODO en un ÚNICO comando `rsync` (sólo cambios)
+    o un tar por ssh si no hay rsync, con timeouts y reintentos.
     """
-    # Warm-up para evitar primer bloqueo perezoso de SSH
-    ssh_exec("true", attempts=1, timeout=6)
-
-    # Combinar limpieza + creación en una sola conexión SSH
-    ssh_exec(f'"rm -rf {shlex.quote(remote_proj)} && mkdir -p {shlex.quote(remote_proj)}"', attempts=3, timeout=12)
-
-    exts = ("*.ino", "*.h", "*.cpp")
-    ignore_dirs = {".git", ".vscode", "__pycache__", "binarios", "releases"}
-
-    def is_ignored(path: Path) -> bool:
-        parts = {part.lower() for part in path.parts}
-        return any(d in parts for d in ignore_dirs)
-
-    # Reunir candidatos recursivamente
-    files = []
-    for pattern in exts:
-        for f in Path(".").rglob(pattern):
-            if f.is_file() and not is_ignored(f):
-                files.append(f)
-
-    # Añadir libraries.txt (si existe en raíz)
-    lib_file = Path("libraries.txt")
-    if lib_file.exists():
-        files.append(lib_file)
+    # Candidatos del recorrido ya hecho por hash_proyecto (+ libraries.txt en raíz)
+    files = [path for rel, path, _ in escanear_proyecto()
+             if path.suffix in SOURCE_SUFFIXES or rel == "libraries.txt"]
 
     if not files:
         sys.exit("❌ No hay archivos .ino, .h, .cpp ni libraries.txt para subir.")
@@ -258,9 +521,20 @@ def subir_proyecto(remote_proj):
             print(f"   - {name}: {a}  <->  {b}")
         sys.exit("Renombra los archivos duplicados antes de subir.")
 
-    # Construir lista de rutas locales y subir en un ÚNICO scp (rápido)
-    local_paths = [str(p) for p in by_name.values()]
-    scp_upload_many(local_paths, remote_proj, attempts=3, timeout=90)
+    q_proj = shlex.quote(remote_proj)
+
+    # Sin rm -rf: se conserva build/ (caché incremental de arduino-cli) y lo ya
+    # subido; sólo se borran los archivos que ya no existen en local
+    keep = " ".join(f"! -name {shlex.quote(name)}" for name in by_name)
+    prep = f"mkdir -p {q_proj} && find {q_proj} -maxdepth 1 -type f {keep} -delete"
+
+    if rsync_disponible():
+        # rsync sólo manda diferencias
+        ssh_exec(prep, attempts=3, timeout=12)
+        rsync_upload_many([str(p) for p in by_name.values()], remote_proj, attempts=3, timeout=90)
+    else:
+        # Preparación y subida en una sola conexión: tar generado al vuelo → ssh
+        tar_upload_many(by_name, remote_proj, pre_cmd=prep, attempts=3, timeout=90)
 
 
 def mostrar_ayuda():
@@ -274,9 +548,18 @@ Uso:
   arcompile fqbn=<VENDOR:ARCH:BOARD>
                                → usa un FQBN exacto
   arcompile min_spiffs         → (ESP32) fuerza particiones min_spiffs
+  arcompile force              → recompila aunque no haya cambios
+  arcompile save <nombre> [placa]
+                               → guarda ./binarios como releases/<nombre>
+  arcompile flash <nombre> [COMx|all]
+                               → flashea una release sin recompilar
+                                 (all: todas las ESP32 conectadas a la vez)
   arcompile update             → actualiza arcompile
   arcompile help               → esta ayuda
 
+Variables de entorno:
+  ARCOMPILE_FAST_LAN=1         → sin compresión ssh (redes locales rápidas)
+
 Ejemplos:
   arcompile esp32c3
   arcompile fqbn=esp32:esp32:esp32c3
@@ -286,46 +569,129 @@ Ejemplos:
     sys.exit(0)
 
 
-def get_remote_version():
+def get_remote_version(usar_ttl=True, silencioso=False):
+    """
+    Versión publicada en el repo. Se cachea en VERSION_CACHE: dentro del TTL no se
+    toca la red, y fuera de él se hace un GET condicional (If-None-Match) que
+    devuelve 304 sin cuerpo si no hubo cambios.
+    Con usar_ttl=False o ARCOMPILE_FORCE_VERSION_CHECK definido se ignora el TTL.
+    """
+    try:
+        cache = json.loads(VERSION_CACHE.read_text(encoding="utf8"))
+    except (OSError, ValueError):
+        cache = {}
+    cached = cache.get("version")
+    forzar = not usar_ttl or bool(os.environ.get("ARCOMPILE_FORCE_VERSION_CHECK"))
+    if cached and not forzar and time.time() - cache.get("ts", 0) < VERSION_CACHE_TTL:
+        return cached
+
+    headers = {"If-None-Match": cache["etag"]} if cached and cache.get("etag") else {}
     try:
-        resp = requests.get(REPO_VERSION_URL, timeout=5)
-        resp.raise_for_status()
-        for line in resp.text.splitlines():
-            if line.startswith("__version__"):
-                return line.split("=")[1].strip().strip('"').strip("'")
+        # Diferido (sólo hace falta cuando caduca la caché) y dentro del try:
+        # requests no es una dependencia declarada y puede no estar instalado
+        import requests
+        # Sin conexión no merece la pena esperar (requests no reintenta por defecto)
+        resp = requests.get(REPO_VERSION_URL, timeout=2, headers=headers)
+        if resp.status_code == 304:
+            version = cached
+        else:
+            resp.raise_for_status()
+            version = None
+            for line in resp.text.splitlines():
+                if line.startswith("__version__"):
+                    version = line.split("=")[1].strip().strip('"').strip("'")
+                    break
+        if version:
+            # Escritura atómica: otro arcompile puede estar leyéndola a la vez
+            VERSION_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            tmp = VERSION_CACHE.with_name(f"{VERSION_CACHE.name}.{os.getpid()}.tmp")
+            tmp.write_text(json.dumps({
+                "version": version,
+                "etag": resp.headers.get("ETag", cache.get("etag")),
+                "ts": time.time(),
+            }), encoding="utf8")
+            os.replace(tmp, VERSION_CACHE)
+        return version
     except Exception as e:
-        print(f"⚠ No se pudo obtener versión remota: {e}")
+        if not silencioso:
+            print(f"⚠ No se pudo obtener versión remota: {e}")
     return None
 
 
+def comprobar_version_en_segundo_plano():
+    """
+    Consulta la versión publicada en un hilo (solapada con la compilación) y,
+    al terminar arcompile, avisa si hay una más nueva. Nunca hace esperar.
+    """
+    resultado = {}
+    hilo = threading.Thread(target=lambda: resultado.update(v=get_remote_version(silencioso=True)),
+                            daemon=True)
+    hilo.start()
+
+    @atexit.register
+    def _avisar():
+        remote = resultado.get("v")
+        if remote and remote != VERSION:
+            print(f"ℹ Nueva versión de arcompile disponible ({VERSION} → {remote}). "
+                  "Ejecuta: arcompile update")
+
+
 def realizar_update():
-    remote = get_remote_version()
+    # Petición condicional aunque la caché esté al día: un 304 cuesta muy poco
+    remote = get_remote_version(usar_ttl=False)
     if not remote:
         sys.exit("❌ No se pudo comprobar la versión remota.")
     if remote == VERSION:
         print(f"✔ Ya tienes la última versión ({VERSION}).")
         sys.exit(0)
     print(f"🔄 Nueva versión disponible: {remote} → actualizando …")
-    run("pip uninstall -y arcompile")
-    run("pip install --no-cache-dir --force-reinstall git+https://github.com/jaestefaniah27/online_compiler.git")
+    run([sys.executable, "-m", "pip", "uninstall", "-y", "arcompile"])
+    run([sys.executable, "-m", "pip", "install", "--no-cache-dir", "--force-reinstall",
+         "git+https://github.com/jaestefaniah27/online_compiler.git"])
     print(f"✅ arcompile actualizado a {remote}")
     sys.exit(0)
 
 
+def _recorrer(root: str, exts: set, ignorar: set):
+    """
+    Recorrido recursivo con os.scandir: devuelve las DirEntry de archivos con
+    extensión en `exts`, sin entrar en las carpetas de `ignorar`. scandir ya trae
+    el tipo (y en Windows el stat) de cada entrada: no hay un stat por archivo.
+    """
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name.lower() not in ignorar:
+                    yield from _recorrer(entry.path, exts, ignorar)
+            elif os.path.splitext(entry.name)[1] in exts and entry.is_file():
+                yield entry
+
+
+@lru_cache(maxsize=1)
+def escanear_proyecto() -> tuple:
+    """
+    Único recorrido del proyecto por ejecución, compartido por hash_proyecto,
+    estimar_tiempo y subir_proyecto: tuplas (ruta relativa posix, Path, stat)
+    de los .ino/.cpp/.h/.txt fuera de IGNORE_DIRS, ordenadas por ruta.
+    """
+    cwd = os.getcwd()
+    archivos = []
+    for entry in _recorrer(cwd, SOURCE_SUFFIXES | {".txt"}, IGNORE_DIRS):
+        rel = Path(os.path.relpath(entry.path, cwd))
+        archivos.append((rel.as_posix(), rel, entry.stat()))
+    return tuple(sorted(archivos, key=lambda a: a[0]))
+
+
 def estimar_tiempo():
-    total_lineas = 0
-    for ext in (".ino", ".cpp", ".h"):
-        for file in Path.cwd().rglob(f"*{ext}"):
-            try:
-                total_lineas += sum(1 for _ in file.open(encoding='utf8', errors='ignore'))
-            except Exception:
-                continue
+    # Es sólo una estimación: se deduce del tamaño, sin abrir ningún archivo
+    total_bytes = sum(st.st_size for _, path, st in escanear_proyecto()
+                      if path.suffix in SOURCE_SUFFIXES)
+    total_lineas = total_bytes // AVG_BYTES_PER_LINE
     estimado = total_lineas * TIME_PER_LINE
     print(f"⏳ Estimación de compilación basada en {total_lineas} líneas: ~{estimado:.1f} s")
 
 
 def compilar_en_servidor(remote_proj, libs, particion=None, fqbn_base=None):
-    ERROR_LOG.write_text("", encoding='utf8')
     estimar_tiempo()
     print("🏗 Iniciando compilación")
     fqbn = fqbn_base or FQBN_DEFAULT
@@ -335,114 +701,174 @@ def compilar_en_servidor(remote_proj, libs, particion=None, fqbn_base=None):
         print(f"• Forzando particiones: {particion}")
         fqbn = f"{fqbn}:PartitionScheme={particion}"
 
-    compile_cmd = (
-        f"ssh {SSH_BASE_OPTS} {REMOTE} /usr/local/bin/arduino-cli compile "
-        f"--fqbn {shlex.quote(fqbn)} "
-        f"{shlex.quote(remote_proj)} --export-binaries"
+    # build-path fijo (los artefactos quedan ahí, sin tener que buscarlos luego)
+    # y caché del core compartida entre ejecuciones y proyectos
+    build_remote = f"{remote_proj}/build"
+    compilar = shlex.join([
+        "/usr/local/bin/arduino-cli", "compile",
+        "--fqbn", fqbn,
+        "--build-path", build_remote,
+        "--build-cache-path", REMOTE_CACHE_DIR,
+        remote_proj,
+    ])
+    # Compilación y descarga en la MISMA ejecución remota: la salida del
+    # compilador va por stderr y, si compila, stdout trae un tar con sólo los
+    # .bin/.hex útiles (nunca imágenes combinadas ni .elf/.map)
+    empaquetar = (
+        f"cd {shlex.quote(build_remote)} && find . -maxdepth 1 -type f "
+        "\\( -iname '*.bin' -o -iname '*.hex' \\) "
+        "! -iname '*with_bootloader*' ! -iname '*merged*' | tar -cf - -T -"
     )
+    compile_cmd = ["ssh", *SSH_BASE_OPTS, REMOTE, f"{compilar} 1>&2 && {empaquetar}"]
+    out_dir = Path("binarios")
+    out_dir.mkdir(exist_ok=True)
+
+    # Sólo hay ssh extra si libraries.txt cambió desde la última instalación
+    instalar_librerias(libs)
 
     for intento in (1, 2):
-        code, out, err = run_capture(compile_cmd)
+        # En el primer intento, una cabecera que falta corta la compilación al momento
+        corte = _MISSING_HEADER_RE if intento == 1 and libs else None
+        # error.log refleja sólo el último intento (un reintento correcto lo deja vacío)
+        ERROR_LOG.write_text("", encoding='utf8')
+        # El tar trae el juego completo de artefactos: los de compilaciones
+        # anteriores (otro sketch u otra placa) no deben poder elegirse al flashear.
+        # La huella se va con ellos: si esta compilación falla, la siguiente
+        # ejecución debe recompilar en vez de buscar artefactos que ya no existen
+        BUILD_HASH.unlink(missing_ok=True)
+        for viejo in out_dir.iterdir():
+            if viejo.suffix.lower() in {".bin", ".hex"} and viejo.is_file():
+                viejo.unlink()
+        code, err = run_capture(compile_cmd, out_dir, abort_on=corte)
         if code == 0:
             print("✓ Compilación exitosa")
-            return fqbn, (out + err)
-        if intento == 1 and ("No such file or directory" in err or "not found" in err):
+            return fqbn, err
+        # Reinstalar sólo si falta una cabecera (p.ej. servidor reinstalado)
+        if corte and _MISSING_HEADER_RE.search(err):
             print("⚠ Faltan librerías → instalando y reintentando …")
-            instalar_librerias(libs)
+            # Sin pty el compilador remoto no muere con el ssh: se para a mano
+            # para que no siga escribiendo en build/ durante el reintento
+            # ("[a]rduino" evita que pkill se encuentre a sí mismo)
+            patron = f"[a]rduino-cli compile .*--build-path {build_remote}"
+            ssh_exec(f"pkill -f {shlex.quote(patron)} || true", attempts=1, timeout=10)
+            instalar_librerias(libs, forzar=True)
             continue
-        print(out + err)
         sys.exit("❌ Compilación abortada")
 
 
 def binario_excede_tamano(salida):
-    for linea in salida.splitlines():
-        if "Sketch uses" in linea and "Maximum is" in linea:
-            try:
-                usado = int(linea.split("Sketch uses")[1].split("bytes")[0].strip().replace(",", ""))
-                print(f"• Binario ocupa {usado} bytes")
-                return usado > MAX_SIZE
-            except:
-                pass
-    return False
-
-def is_exact_bootloader(name: str) -> bool:
-    return name.endswith(".bootloader.bin") and "with_bootloader" not in name
-
-def descargar_binarios(build_remote, sketch_name) -> Dict[str, Path]:
-    out_dir = Path("binarios")
-    out_dir.mkdir(exist_ok=True)
-
-    # Listar en remoto y traer SOLO *.bin y *.hex
-    ls_cmd = f"ssh {REMOTE} ls -1 {shlex.quote(build_remote)}"
-    code_ls, out_ls, err_ls = run_capture(ls_cmd)
-    if code_ls != 0:
-        print(out_ls + err_ls)
-        sys.exit("❌ No se pudo listar la carpeta de build remota.")
-
-    remote_files = [line.strip() for line in out_ls.splitlines() if line.strip()]
-    wanted = [f for f in remote_files if f.lower().endswith((".bin", ".hex"))]
-    if not wanted:
+    m = _SKETCH_RE.search(salida)
+    if not m:
+        return False
+    usado = int(m.group(1).replace(",", ""))
+    maximo = int(m.group(2).replace(",", ""))
+    print(f"• Binario ocupa {usado} de {maximo} bytes")
+    # También si apenas queda margen en la partición actual (<5 %)
+    return usado > MAX_SIZE or usado > maximo * 0.95
+
+def _asignar_roles(archivos, app_plana: Optional[str] = None):
+    """
+    Una sola pasada: asigna a cada artefacto su rol (bootloader, partitions, …)
+    con _ART_RE. Devuelve (roles, nombres de imágenes combinadas ignoradas,
+    rol → nombres cuando varios archivos optan al mismo rol).
+    app_plana: nombre (en minúsculas) que también cuenta como aplicación; con
+    None vale cualquier otro .bin.
+    """
+    roles: Dict[str, Path] = {}
+    ignorados: list[str] = []
+    repetidos: Dict[str, list[str]] = {}
+    for archivo in archivos:
+        name = archivo.name.lower()
+        if _COMBINED_RE.search(name):
+            ignorados.append(archivo.name)
+            continue
+        m = _ART_RE.match(name)
+        if m:
+            rol = m.lastgroup
+            if rol in roles:
+                repetidos.setdefault(rol, [roles[rol].name]).append(archivo.name)
+            roles[rol] = archivo
+        elif name == app_plana or (app_plana is None and name.endswith(".bin")):
+            roles.setdefault("application", archivo)
+    return roles, ignorados, repetidos
+
+
+def clasificar_binarios(sketch_name) -> Dict[str, Path]:
+    """Asigna un rol (bootloader, partitions, …) a los artefactos ya traídos a ./binarios."""
+    # La aplicación también puede llamarse <sketch>.bin (sin .ino)
+    app_plana = sketch_name.lower().removesuffix(".ino") + ".bin"
+    local_files, ignorados, _ = _asignar_roles(Path("binarios").glob("*.*"), app_plana)
+
+    if ignorados:
+        print(f"ℹ Ignorando imágenes combinadas: {', '.join(sorted(ignorados))}")
+    if not local_files:
         sys.exit("❌ No hay artefactos .bin/.hex en el build remoto.")
 
-    # Construye una sola llamada scp con todas las rutas remotas y el destino local
-    remote_srcs = " ".join(
-        f'{REMOTE}:"{build_remote}/{fn}"' for fn in wanted
-    )
-    single_scp_cmd = f"scp {SCP_BASE_OPTS} {remote_srcs} binarios/"
-
-    # Timeout y reintentos para una descarga robusta
-    run_retry(single_scp_cmd, attempts=3, timeout=120)
-
-    local_files: Dict[str, Path] = {}
-
-    def is_exact_bootloader(name: str) -> bool:
-        # Acepta exactamente *.bootloader.bin, NO *.with_bootloader.bin
-        return name.endswith(".bootloader.bin") and "with_bootloader" not in name
+    print("✅ Artefactos descargados en ./binarios/ (solo .bin y .hex)")
+    return local_files
 
-    def is_exact_partitions(name: str) -> bool:
-        return name.endswith(".partitions.bin")
 
-    def is_boot_app0(name: str) -> bool:
-        return name.endswith("app0.bin") and "with_bootloader" not in name and "merged" not in name
+def _nuevo_digest():
+    # Sólo detecta cambios (no es una primitiva de seguridad): blake2b de 128 bits
+    # es bastante más rápido que sha256 en CPUs de 64 bits y viene en la stdlib
+    return hashlib.blake2b(digest_size=16)
 
-    def is_application_bin(name: str) -> bool:
-        # Acepta *.ino.bin o <sketch>.bin, nunca with_bootloader/merged
-        if "with_bootloader" in name or "merged" in name:
-            return False
-        if name.endswith(".ino.bin"):
-            return True
-        base = sketch_name.lower().removesuffix(".ino")
-        return name == f"{base}.bin"
 
-    # Mapear roles con reglas estrictas
-    for archivo in out_dir.glob("*.*"):
-        name = archivo.name.lower()
-        if name.endswith(".hex"):
-            local_files["application_hex"] = archivo
-        elif is_exact_bootloader(name):
-            local_files["bootloader"] = archivo
-        elif is_exact_partitions(name):
-            local_files["partitions"] = archivo
-        elif is_boot_app0(name):
-            local_files["boot_app0"] = archivo
-        elif name.endswith(".bin") and is_application_bin(name):
-            local_files["application"] = archivo
-
-    # Aviso si ignoramos imágenes combinadas
-    bad = [p.name for p in out_dir.glob("*.bin") if ("with_bootloader" in p.name.lower() or "merged" in p.name.lower())]
-    if bad:
-        print("ℹ Ignorando imágenes combinadas:", ", ".join(bad))
-
-    print("✅ Artefactos descargados en ./binarios/ (solo .bin y .hex)")
-    return local_files
+def _digest_archivo(path: Path) -> str:
+    # Sin copiar el archivo a un bytes de Python: file_digest (3.11+) o mmap
+    with path.open("rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, _nuevo_digest).hexdigest()
+        h = _nuevo_digest()
+        if os.fstat(f.fileno()).st_size:  # mmap no admite archivos vacíos
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        return h.hexdigest()
 
 
 def hash_proyecto():
-    sha = hashlib.sha256()
-    for path in sorted(Path.cwd().rglob("*")):
-        if path.is_file() and path.suffix in {".ino", ".cpp", ".h", ".txt"}:
-            sha.update(path.read_bytes())
-    return sha.hexdigest()
+    """
+    Huella del proyecto: blake2b de cada fuente (calculados en paralelo) combinados
+    en orden de ruta. Los archivos con el mismo (mtime, tamaño) que en la última
+    ejecución reutilizan su digest de HASH_CACHE sin volver a leerse.
+    """
+    try:
+        cache = json.loads(HASH_CACHE.read_text(encoding="utf8"))
+    except (OSError, ValueError):
+        cache = {}
+
+    entries = {}
+    pendientes = []
+    for rel, path, st in escanear_proyecto():
+        key = [st.st_mtime_ns, st.st_size]
+        prev = cache.get(rel)
+        if prev and prev[:2] == key:
+            entries[rel] = prev
+        else:
+            pendientes.append((rel, path, key))
+
+    if pendientes:
+        paths = [path for _, path, _ in pendientes]
+        if len(paths) < 8:
+            # Pocos archivos: arrancar hilos cuesta más de lo que ahorra
+            digests = [_digest_archivo(p) for p in paths]
+        else:
+            # La lectura y el hashing liberan el GIL: los hilos sí solapan E/S
+            with ThreadPoolExecutor(max_workers=min(16, (os.cpu_count() or 2) * 4)) as ex:
+                digests = list(ex.map(_digest_archivo, paths))
+        for (rel, _, key), digest in zip(pendientes, digests):
+            entries[rel] = key + [digest]
+    if pendientes or len(entries) != len(cache):
+        # Escritura atómica: una ejecución interrumpida no deja el índice a medias
+        tmp = HASH_CACHE.with_name(HASH_CACHE.name + ".tmp")
+        tmp.write_text(json.dumps(entries), encoding="utf8")
+        os.replace(tmp, HASH_CACHE)
+
+    h = _nuevo_digest()
+    for rel in sorted(entries):
+        _, size, digest = entries[rel]
+        h.update(f"{rel}\0{size}\0{digest}\n".encode())
+    return h.hexdigest()
 
 
 def resolver_fqbn_desde_args(args_list):
@@ -452,37 +878,54 @@ def resolver_fqbn_desde_args(args_list):
       - fqbn=VENDOR:ARCH:BOARD
       - si no hay nada, usa FQBN_DEFAULT
     """
-    fqbn = None
-    for a in args_list:
+    # Gana el último: se recorre al revés y se corta en la primera coincidencia
+    for a in reversed(args_list):
         if a.startswith("fqbn="):
-            fqbn = a.split("=", 1)[1]
-        elif a in BOARD_ALIASES:
-            fqbn = BOARD_ALIASES[a]
-    return fqbn or FQBN_DEFAULT
+            return a.split("=", 1)[1] or FQBN_DEFAULT
+        fqbn = BOARD_ALIASES.get(a)
+        if fqbn:
+            return fqbn
+    return FQBN_DEFAULT
 
 
+def extraer_fqbn_de_compile_log() -> Optional[str]:
+    """
+    FQBN usado en la última compilación (según compile.log), o None.
+    La cabecera va al principio: basta con los primeros 64 KB, y sólo si no
+    aparece ahí se recorre el resto mapeado en memoria.
+    """
+    try:
+        with COMPILE_LOG.open("rb") as f:
+            m = _FQBN_RE.search(f.read(65536))
+            if not m and f.tell() == 65536:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    m = _FQBN_RE.search(mm)
+                    return m.group(1).decode() if m else None
+    except OSError:
+        return None
+    return m.group(1).decode() if m else None
+
+
+@lru_cache(maxsize=8)
 def familia_chip_de_fqbn(fqbn: str) -> str:
     """
     Devuelve la familia: 'esp32', 'esp32c3', 'esp32s3' o 'avr' (Arduino AVR).
     """
-    try:
-        vendor, arch, board = fqbn.split(":")
-        vendor = vendor.lower()
-        arch   = arch.lower()
-        board  = board.lower()
-    except Exception:
-        vendor, arch, board = "", "", ""
+    # Un FQBN puede llevar opciones detrás (esp32:esp32:esp32c3:PartitionScheme=…)
+    parts = fqbn.lower().split(":")
+    if len(parts) < 3:
+        return "esp32"
+    vendor, arch, board = parts[:3]
 
     if arch == "avr" or vendor == "arduino":
         return "avr"
-    if "c3" in board:
-        return "esp32c3"
-    if "s3" in board:
-        return "esp32s3"
+    for sufijo, familia in _FAMILY_BY_BOARD_SUFFIX:
+        if sufijo in board:
+            return familia
     return "esp32"
 
 
-def construir_flash_cmd(esptool, com, baud, files, family):
+def construir_flash_cmd(esptool, com, baud, files, family, stub=True):
     """
     Construye el comando esptool write_flash con offsets correctos por familia (ESP32*).
     Para AVR no se usa esptool: se sube con arduino-cli upload --input-dir.
@@ -492,31 +935,76 @@ def construir_flash_cmd(esptool, com, baud, files, family):
     layout = FLASH_LAYOUT.get(family, FLASH_LAYOUT["esp32"])
 
     parts = []
-    # bootloader
-    if "bootloader" in files and files["bootloader"].exists():
-        parts += [f"0x{layout['bootloader']:x}", str(files["bootloader"])]
-
-    # partitions
-    if "partitions" in files and files["partitions"].exists():
-        parts += [f"0x{layout['partitions']:x}", str(files["partitions"])]
-
-    # boot_app0 (solo si la familia lo usa y existe el archivo)
-    if layout.get("use_boot_app0", False) and "boot_app0" in files and files["boot_app0"].exists():
-        parts += [f"0x{layout['boot_app0']:x}", str(files["boot_app0"])]
-
-    # aplicación
-    if "application" in files and files["application"].exists():
-        parts += [f"0x{layout['application']:x}", str(files["application"])]
+    # Orden de escritura: bootloader, particiones, boot_app0 (si la familia lo
+    # usa) y aplicación
+    for rol, offset in (("bootloader", layout.bootloader),
+                        ("partitions", layout.partitions),
+                        ("boot_app0", layout.boot_app0),
+                        ("application", layout.application)):
+        if offset is not None and rol in files and files[rol].exists():
+            parts += [f"0x{offset:x}", str(files[rol])]
 
     if not parts:
         sys.exit("❌ No se encontraron binarios para flashear (ESP32).")
 
     # Sin --chip → esptool auto-detecta (evita 'Wrong --chip argument?')
-    flash_cmd = (
-        f"{esptool} --port {com} --baud {baud} write_flash -z " +
-        " ".join(parts)
-    )
-    return flash_cmd
+    extra = [] if stub else ["--no-stub"]
+    return [*esptool, "--port", com, "--baud", str(baud), *extra, "write_flash", "-z", *parts]
+
+
+def _wait_for_port(com: str, timeout: float = 3.0) -> bool:
+    """Sondea los puertos cada 200 ms hasta que `com` vuelva a enumerarse."""
+    from serial.tools import list_ports
+    limite = time.monotonic() + timeout
+    while True:
+        activos = _puertos_activos_windows()
+        if activos is None:
+            activos = {p.device for p in list_ports.comports()}
+        if com.lower() in {d.lower() for d in activos}:
+            return True
+        if time.monotonic() >= limite:
+            return False
+        time.sleep(0.2)
+
+
+def _esptool_en_proceso(args: list[str]):
+    """
+    Ejecuta esptool dentro de este intérprete (sin pagar el arranque de otro
+    Python). Los fallos se traducen a CalledProcessError, como con run().
+    """
+    print("» esptool", shlex.join(args))
+    import esptool
+    try:
+        esptool.main(args)
+    except SystemExit as e:
+        if e.code:
+            raise subprocess.CalledProcessError(e.code, ["esptool", *args]) from e
+    except Exception as e:  # FatalError, SerialException, …
+        print(f"⚠ esptool: {e}")
+        raise subprocess.CalledProcessError(1, ["esptool", *args]) from e
+
+
+def flashear_esp32(com, baud, files, family, esptool=None):
+    """
+    Flashea con esptool reintentando a baudios más bajos (y sin stub) si falla.
+    Entre intentos espera a que el puerto reaparezca en vez de dormir a ciegas.
+    esptool: prefijo argv a usar en lugar de resolve_esptool().
+    """
+    if esptool is None:
+        esptool = resolve_esptool()
+    ejecutar = run if esptool else _esptool_en_proceso
+    intentos = [(baud, True), (460800, True), (460800, False), (230400, True)]
+    for i, (b, stub) in enumerate(intentos):
+        if i and not _wait_for_port(com, 3.0):
+            print(f"⚠ {com} no reaparece; se omite el intento a {b} baudios")
+            continue
+        try:
+            ejecutar(construir_flash_cmd(esptool, com, b, files, family, stub=stub))
+            return
+        except subprocess.CalledProcessError:
+            if i + 1 < len(intentos):
+                print(f"⚠ Falló el flasheo a {b} baudios → reintentando …")
+    sys.exit(f"❌ No se pudo flashear en {com}")
 
 # ===== Releases (guardar/flash sin recompilar) =====
 
@@ -551,65 +1039,86 @@ def read_meta(dirpath: Path) -> dict:
             d[k.strip()] = v.strip()
     return d
 
+# Almacén por contenido de las releases (nombre reservado: no puede ser una release)
+OBJECTS_DIR = "_objects"
+
+
+def _guardar_objeto(f: Path, dst: Path):
+    """
+    Guarda f en dst deduplicando por contenido: el contenido vive una sola vez en
+    releases/_objects/<hh>/<digest> y cada release tiene un hardlink a él (el
+    bootloader/particiones de una misma placa casi nunca cambian entre releases).
+    Si no se pueden crear hardlinks (p.ej. FAT32), se copia normalmente.
+    copyfile y no copy2: los metadatos no sirven de nada en un binario, y
+    copyfile usa la copia en kernel (sendfile/copy_file_range) cuando puede.
+    """
+    digest = _digest_archivo(f)
+    obj = releases_dir() / OBJECTS_DIR / digest[:2] / digest
+    try:
+        if not obj.exists():
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(f, obj)
+        os.link(obj, dst)
+    except OSError:
+        shutil.copyfile(f, dst)
+
+
+def _podar_objetos():
+    """
+    Borra del almacén los objetos que ya no usa ninguna release (st_nlink == 1:
+    sólo queda el enlace del propio almacén, p.ej. tras borrar una release a
+    mano o cuando no se pudo crear el hardlink).
+    """
+    raiz = releases_dir() / OBJECTS_DIR
+    if not raiz.is_dir():
+        return
+    for sub in raiz.iterdir():
+        if not sub.is_dir():
+            continue
+        for obj in sub.iterdir():
+            if obj.is_file() and obj.stat().st_nlink == 1:
+                obj.unlink()
+        if not any(sub.iterdir()):
+            sub.rmdir()
+
+
 def save_release(name: str, fqbn: str, family: str):
+    if name == OBJECTS_DIR:
+        sys.exit(f"❌ '{OBJECTS_DIR}' es un nombre reservado. Elige otro nombre.")
     src = Path("binarios")
     if not src.exists():
         sys.exit("❌ No hay carpeta ./binarios. Compila primero.")
+    # Mismas reglas que al flashear (nunca imágenes combinadas); con dos
+    # aplicaciones candidatas no se adivina cuál es la buena
+    app_plana = Path.cwd().name.lower() + ".bin"
+    roles, _, repetidos = _asignar_roles(src.glob("*.*"), app_plana)
+    for rol in ("application", "application_hex"):
+        if rol in repetidos:
+            sys.exit(f"❌ Varias aplicaciones en ./binarios ({', '.join(repetidos[rol])}). "
+                     "Recompila (arcompile force) para dejar sólo la actual.")
+    if not roles:
+        sys.exit("❌ No se encontraron artefactos en ./binarios para guardar.")
+
     dst = releases_dir() / name
     if dst.exists():
         sys.exit(f"❌ Ya existe releases/{name}. Elige otro nombre.")
     dst.mkdir(parents=True)
-
-    # Copia archivos relevantes
-    copied = 0
-    # ESP32 típicos:
-    for fn in ["main.ino.bootloader.bin", "main.ino.partitions.bin", "main.ino.bin", "boot_app0.bin",
-               f"{Path.cwd().name}.ino.bootloader.bin",
-               f"{Path.cwd().name}.ino.partitions.bin",
-               f"{Path.cwd().name}.ino.bin"]:
-        f = src / fn
-        if f.exists():
-            shutil.copy2(f, dst / f.name)
-            copied += 1
-
-    # AVR: .hex
-    for fn in ["main.ino.hex", f"{Path.cwd().name}.ino.hex", f"{Path.cwd().name}.hex"]:
-        f = src / fn
-        if f.exists():
-            shutil.copy2(f, dst / f.name)
-            copied += 1
-
-    if copied == 0:
-        sys.exit("❌ No se encontraron artefactos en ./binarios para guardar.")
+    # Copia archivos relevantes (ESP32: .bin por rol; AVR: .hex)
+    for f in roles.values():
+        _guardar_objeto(f, dst / f.name)
 
     write_meta(dst, fqbn, family)
+    _podar_objetos()
     print(f"✅ Guardado en releases/{name}")
 
 def load_release_bins(name: str) -> Tuple[Dict[str, Path], str]:
     rdir = releases_dir() / name
-    if not rdir.exists():
+    if name == OBJECTS_DIR or not rdir.exists():
         sys.exit(f"❌ No existe releases/{name}")
     meta = read_meta(rdir)
     family = meta.get("FAMILY", "esp32")
 
-    files: Dict[str, Path] = {}
-    candidates = list(rdir.glob("*.*"))
-    for archivo in candidates:
-        low = archivo.name.lower()
-        if low.endswith(".hex"):
-            files["application_hex"] = archivo
-        elif "bootloader" in low and low.endswith(".bin"):
-            files["bootloader"] = archivo
-        elif "partition" in low and low.endswith(".bin"):
-            files["partitions"] = archivo
-        elif "app0" in low and low.endswith(".bin"):
-            files["boot_app0"] = archivo
-        elif low.endswith(".ino.bin"):
-            files["application"] = archivo
-        elif low.endswith(".bin") and all(t not in low for t in ("partition","bootloader","app0")):
-            # fallback .bin de aplicación
-            files["application"] = archivo
-
+    files, _, _ = _asignar_roles(rdir.glob("*.*"))
     return files, family
 
 def flash_release(name: str, port: Optional[str], baud: int):
@@ -622,7 +1131,7 @@ def flash_release(name: str, port: Optional[str], baud: int):
             meta = read_meta(releases_dir()/name)
             if meta.get("FQBN"):
                 fqbn = meta["FQBN"]
-        com = port or puerto_esp32()
+        com = port or puerto_esp32(avr=True)
         cmd = [
             cli, "upload",
             "--fqbn", fqbn,
@@ -635,18 +1144,59 @@ def flash_release(name: str, port: Optional[str], baud: int):
         return
 
     # ESP32
-    esptool = shutil.which("esptool.py") or f"{sys.executable} -m esptool"
     com = port or puerto_esp32()
-    cmd = construir_flash_cmd(esptool, com, baud, files, family)
-    run(cmd)
+    flashear_esp32(com, baud, files, family)
     print(f"✅ Flash de release '{name}' completado en {com}")
 
+
+def flash_release_todas(name: str, baud: int):
+    """
+    Flashea la release en todas las placas conectadas a la vez: un esptool por
+    puerto, así N placas tardan casi lo mismo que una.
+    """
+    files, family = load_release_bins(name)
+    if family == "avr":
+        sys.exit("❌ 'all' sólo está disponible para releases ESP32.")
+    # Sólo puertos con (VID, PID) de ESP32 conocido: las placas AVR y los puertos
+    # que sólo se parecen a una placa por su descripción quedan fuera
+    puertos = tuple(dev for dev, vidpid in _escanear_puertos() if vidpid in _ESP_VIDPID)
+    omitidos = [dev for dev, vidpid in _escanear_puertos() if vidpid not in _KNOWN_VIDPID]
+    if omitidos:
+        print(f"ℹ Se omiten puertos no reconocidos como ESP32: {', '.join(omitidos)} "
+              f"(usa 'arcompile flash {name} <PUERTO>' para flashear uno concreto)")
+    if not puertos:
+        sys.exit("❌ No se detectó ninguna placa ESP32 conectada.")
+    print(f"🔌 Flasheando en paralelo en {len(puertos)} placas: {', '.join(puertos)}")
+    # esptool en proceso no es reentrante: en paralelo va siempre como subproceso
+    esptool = resolve_esptool() or (sys.executable, "-m", "esptool")
+
+    def _flashear(com) -> bool:
+        try:
+            flashear_esp32(com, baud, files, family, esptool=esptool)
+            return True
+        except SystemExit as e:
+            print(e.code)
+            return False
+
+    with ThreadPoolExecutor(max_workers=len(puertos)) as ex:
+        resultados = dict(zip(puertos, ex.map(_flashear, puertos)))
+
+    print("📋 Resumen:")
+    for com, ok in resultados.items():
+        print(f"   {'✅' if ok else '❌'} {com}")
+    fallidos = [com for com, ok in resultados.items() if not ok]
+    if fallidos:
+        sys.exit(f"❌ Falló el flasheo en {len(fallidos)} de {len(puertos)} placas")
+    print(f"✅ Flash de release '{name}' completado en {len(puertos)} placas")
+
+
+@lru_cache(maxsize=1)
 def resolve_arduino_cli() -> str:
     """
-    Intenta localizar arduino-cli de forma portátil.
+    Intenta localizar arduino-cli de forma portátil (una vez por ejecución).
     Prioriza:
       - Variable de entorno ARDUINO_CLI (ruta completa al ejecutable)
-      - which/where
+      - which/where (en Windows, PATHEXT ya resuelve el .exe)
       - ubicaciones típicas en Windows
     """
     # 1) Env var explícita
@@ -655,18 +1205,20 @@ def resolve_arduino_cli() -> str:
         return str(Path(env_cli))
 
     # 2) which / where
-    cand = shutil.which("arduino-cli") or shutil.which("arduino-cli.exe")
+    cand = shutil.which("arduino-cli")
     if cand:
         return cand
 
     # 3) Ubicaciones comunes en Windows
-    if platform.system().lower().startswith("win"):
+    if os.name == "nt":
         home = Path.home()
         candidates = [
             home / "AppData/Local/Programs/arduino-cli/arduino-cli.exe",
             home / "AppData/Local/Arduino CLI/arduino-cli.exe",
             Path("C:/Program Files/arduino-cli/arduino-cli.exe"),
+            Path("C:/Program Files/Arduino CLI/arduino-cli.exe"),
             Path("C:/Program Files (x86)/arduino-cli/arduino-cli.exe"),
+            Path("C:/Program Files (x86)/Arduino CLI/arduino-cli.exe"),
         ]
         for c in candidates:
             if c.exists():
@@ -679,37 +1231,23 @@ def resolve_arduino_cli() -> str:
         "Descarga: https://arduino.github.io/arduino-cli/latest/installation/"
     )
 
-import platform
-import shutil  # ya lo usas arriba
 
-def resolve_arduino_cli() -> str:
+@lru_cache(maxsize=1)
+def resolve_esptool() -> tuple[str, ...]:
     """
-    Localiza arduino-cli de forma portátil.
-    Prioriza ARDUINO_CLI, luego which/where y ubicaciones típicas de Windows.
+    Prefijo argv para lanzar esptool, o () si el módulo es importable y se puede
+    ejecutar en este mismo proceso.
     """
-    env_cli = os.environ.get("ARDUINO_CLI")
-    if env_cli and Path(env_cli).exists():
-        return str(Path(env_cli))
-
-    cand = shutil.which("arduino-cli") or shutil.which("arduino-cli.exe")
-    if cand:
-        return cand
+    import importlib.util
+    if importlib.util.find_spec("esptool"):
+        return ()
+    exe = shutil.which("esptool.py")
+    return (exe,) if exe else (sys.executable, "-m", "esptool")
 
-    if platform.system().lower().startswith("win"):
-        home = Path.home()
-        candidates = [
-            home / "AppData/Local/Programs/arduino-cli/arduino-cli.exe",
-            home / "AppData/Local/Arduino CLI/arduino-cli.exe",
-            Path("C:/Program Files/Arduino CLI/arduino-cli.exe"),
-            Path("C:/Program Files (x86)/Arduino CLI/arduino-cli.exe"),
-        ]
-        for c in candidates:
-            if c.exists():
-                return str(c)
 
-    raise FileNotFoundError(
-        "No se encontró 'arduino-cli'. Instálalo o define ARDUINO_CLI con la ruta completa al ejecutable."
-    )
+@lru_cache(maxsize=1)
+def rsync_disponible() -> bool:
+    return shutil.which("rsync") is not None
 
 
 def main():
@@ -720,22 +1258,24 @@ def main():
     if args and args[0].lower() == "save":
         if len(args) < 2:
             sys.exit("Uso: arcompile save <nombre_release>")
-        fqbn_base = resolver_fqbn_desde_args(args[2:])
+        # Sin placa explícita se usa la de la última compilación
+        if args[2:]:
+            fqbn_base = resolver_fqbn_desde_args(args[2:])
+        else:
+            fqbn_base = extraer_fqbn_de_compile_log() or FQBN_DEFAULT
         family = familia_chip_de_fqbn(fqbn_base)
-        try:
-            with open(COMPILE_LOG, "r", encoding="utf8") as f:
-                _ = f.read()
-        except Exception:
-            pass
         save_release(args[1], fqbn_base, family)
         return
 
     if args and args[0].lower() == "flash":
         if len(args) < 2:
-            sys.exit("Uso: arcompile flash <nombre_release> [COMx]")
+            sys.exit("Uso: arcompile flash <nombre_release> [COMx|all]")
         name = args[1]
         port = args[2] if len(args) >= 3 else None
-        flash_release(name, port, BAUD)
+        if port == "all":
+            flash_release_todas(name, BAUD)
+        else:
+            flash_release(name, port, BAUD)
         print(f"✅ Terminado en {time.time() - start:.1f} s")
         return
     
@@ -745,6 +1285,8 @@ def main():
     if "update" in args:
         realizar_update()
 
+    comprobar_version_en_segundo_plano()
+
     # Procesa selección de FQBN desde CLI
     fqbn_base = resolver_fqbn_desde_args(args)
     used_fqbn  = fqbn_base  # se actualizará en compilación si aplica
@@ -752,22 +1294,31 @@ def main():
 
     particion = "min_spiffs" if ("min_spiffs" in args and used_family != "avr") else None
 
-    sketch_dir  = Path.cwd()
+    sketch_dir  = Path.cwd()  # una sola vez; el resto de main reutiliza este valor
     sketch_name = sketch_dir.name + ".ino"
     ino_path    = sketch_dir / sketch_name
     if not ino_path.exists():
         sys.exit(f"❌ No se encontró {sketch_name}")
 
+    # Buscar el puerto en segundo plano mientras se hashea, sube y compila
+    port_pool   = ThreadPoolExecutor(max_workers=1)
+    port_future = port_pool.submit(puerto_esp32_optional, used_family == "avr")
+
     libs = leer_libraries()
 
     # === Compilar SIEMPRE, sin requerir puerto conectado ===
-    hash_actual   = hash_proyecto()
-    hash_file     = Path(".build_hash")
+    # La placa y la partición pedidas forman parte de la huella: cambiar de
+    # placa sin tocar el código también obliga a recompilar
+    hash_actual   = f"{hash_proyecto()}:{fqbn_base}:{particion or ''}"
+    hash_file     = BUILD_HASH
     hash_anterior = hash_file.read_text() if hash_file.exists() else ""
+    forzar        = "force" in args or "--force" in args
+    compilado     = forzar or hash_actual != hash_anterior
 
-    if hash_actual != hash_anterior:
+    if compilado:
         print("🛠 Compilación necesaria")
         remote_proj = f"{REMOTE_DIR}/{sketch_dir.name}"
+        abrir_conexion_ssh()
         subir_proyecto(remote_proj)
 
         used_fqbn, salida = compilar_en_servidor(remote_proj, libs, particion, fqbn_base=fqbn_base)
@@ -778,21 +1329,10 @@ def main():
             used_fqbn, salida = compilar_en_servidor(remote_proj, libs, "min_spiffs", fqbn_base=fqbn_base)
             particion = "min_spiffs"
 
-        COMPILE_LOG.write_text(salida, encoding="utf8")
+        COMPILE_LOG.write_text(f"FQBN: {used_fqbn}\n{salida}", encoding="utf8")
         print(f"ℹ Salida de compilación guardada en {COMPILE_LOG}")
 
-        print("🔍 Detectando carpeta de build en el servidor…")
-        code, out, err = run_capture(f"ssh {SSH_BASE_OPTS} {REMOTE} ls {shlex.quote(remote_proj)}/build")
-        if code != 0:
-            print(out + err)
-            sys.exit("❌ No se pudo listar build/ en el servidor.")
-        out = out.split()
-        if not out:
-            sys.exit("❌ No se encontró ningún subdirectorio en build/")
-        carpeta_build = out[0].strip()
-        build_remote = f"{remote_proj}/build/{carpeta_build}"
-
-        bin_files = descargar_binarios(build_remote, sketch_name)
+        bin_files = clasificar_binarios(sketch_name)
         hash_file.write_text(hash_actual)
         used_family = familia_chip_de_fqbn(used_fqbn)
     else:
@@ -803,8 +1343,8 @@ def main():
             cand_hex = [
                 out_dir / f"{sketch_name}.hex",
                 out_dir / f"{sketch_name}.ino.hex",
-                out_dir / f"{Path.cwd().name}.ino.hex",
-                out_dir / f"{Path.cwd().name}.hex",
+                out_dir / f"{sketch_dir.name}.ino.hex",
+                out_dir / f"{sketch_dir.name}.hex",
             ]
             app_hex = next((p for p in cand_hex if p.exists()), None)
             if not app_hex:
@@ -823,7 +1363,12 @@ def main():
                     sys.exit(f"❌ Falta el binario requerido: {f}")
 
     # === Flasheo (sólo si hay puerto disponible ahora) ===
-    com_final = puerto_esp32_optional()
+    com_final = port_future.result()
+    port_pool.shutdown()
+    if not com_final and compilado:
+        # La placa pudo conectarse durante la compilación → un último escaneo
+        _escanear_puertos.cache_clear()
+        com_final = puerto_esp32_optional(used_family == "avr")
     if not com_final:
         print("🚫 No se detectó puerto. La compilación/descarga de artefactos se han completado correctamente.")
         print("📦 Artefactos listos en ./binarios/")
@@ -838,19 +1383,16 @@ def main():
             "--fqbn", used_fqbn,
             "-p", com_final,
             "--input-dir", str(Path("binarios").resolve()),
-            str(Path.cwd().resolve()),
+            str(sketch_dir.resolve()),
         ]
         run(cmd)
     else:
-        esptool = shutil.which("esptool.py") or f"{sys.executable} -m esptool"
-        flash_cmd = construir_flash_cmd(
-            esptool=esptool,
+        flashear_esp32(
             com=com_final,
             baud=BAUD,
             files=bin_files,
             family=used_family
         )
-        run(flash_cmd)
 
     print(f"✅ Terminado en {time.time() - start:.1f} s")
 